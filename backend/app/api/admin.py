@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+
+from app.profiling import get_capture_store, is_admin_token
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """校验 X-Admin-Token 请求头，未配置 ADMIN_TOKEN 时一律拒绝。"""
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+def _store():
+    store = get_capture_store()
+    if store is None:
+        raise HTTPException(status_code=503, detail="Profile capture is not available.")
+    return store
+
+@router.get("/profiles", summary="列出性能剖析捕获")
+def list_profiles():
+    """
+    按时间倒序列出磁盘环形缓冲区中的捕获（不含阶段和调用栈明细）。
+    """
+    return _store().list()
+
+@router.get("/profiles/{capture_id}", summary="下载性能剖析捕获")
+def get_profile(capture_id: str, format: str = "json"):
+    """
+    下载单个捕获。format=json 返回完整的阶段时间线和调用栈；
+    format=folded 返回折叠格式的调用栈，可直接交给 flamegraph.pl 或 speedscope。
+    """
+    capture = _store().load(capture_id)
+    if capture is None:
+        raise HTTPException(status_code=404, detail="Capture not found")
+    if format == "folded":
+        return PlainTextResponse(
+            "\n".join(capture["stacks"]) + "\n",
+            headers={"Content-Disposition": f'attachment; filename="{capture_id}.folded"'},
+        )
+    return capture
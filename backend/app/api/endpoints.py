@@ -4,16 +4,17 @@ from typing import List
 
 from .. import crud, models, schemas
 from ..database import SessionLocal
-from app.services.ocr_service import recognize_text_from_image
+from app.services.ocr_service import ocr_slot, recognize_text_from_image
 from app.services.wechat_service import get_user_openid
 from app.logic.analyzer import parse_nutrition_info, analyze_nutrients
+from app.profiling import ProfiledRoute, stage
+from app.security import create_session_token
 import os
+import time
 import uuid
 import logging
 from pydantic import BaseModel
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Dependency
@@ -27,11 +28,10 @@ def get_db():
 class LoginPayload(BaseModel):
     code: str
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
-# 确保静态文件目录存在
+# 图片存储目录，在应用启动阶段创建（见 main.lifespan）
 STATIC_DIR = "static/images"
-os.makedirs(STATIC_DIR, exist_ok=True)
 
 @router.post("/login", summary="微信登录")
 def login(payload: LoginPayload, db: Session = Depends(get_db)):
@@ -42,7 +42,7 @@ def login(payload: LoginPayload, db: Session = Depends(get_db)):
         # 测试模式：如果code以test_开头，则使用模拟数据
         if payload.code.startswith("test_"):
             openid = f"test_openid_{payload.code}"
-            logger.info(f"Test mode: using mock openid {openid}")
+            logger.info("Test mode: using mock openid %s", openid)
         else:
             user_data = get_user_openid(payload.code)
             openid = user_data.get("openid")
@@ -53,7 +53,11 @@ def login(payload: LoginPayload, db: Session = Depends(get_db)):
         if not db_user:
             db_user = crud.create_user(db, openid=openid)
         
-        return {"openid": db_user.openid, "user_id": db_user.id}
+        return {
+            "openid": db_user.openid,
+            "user_id": db_user.id,
+            "session_token": create_session_token(db_user.id),
+        }
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -61,62 +65,68 @@ def login(payload: LoginPayload, db: Session = Depends(get_db)):
 
 @router.post("/analyze")
 def analyze_image(request: Request, file: UploadFile = File(...), user_id: str = Form(...), db: Session = Depends(get_db)):
-    logger.info(f"Received request for /analyze for user_id: {user_id}")
-    
+    started = time.perf_counter()
+
     # 安全检查：验证文件类型
     if not file.content_type or not file.content_type.startswith('image/'):
-        logger.warning(f"Uploaded file is not an image: {file.content_type}")
+        logger.warning("Uploaded file is not an image: %s", file.content_type)
         raise HTTPException(status_code=400, detail="Uploaded file is not an image.")
 
     try:
         file_extension = os.path.splitext(file.filename)[1]
         filename = f"{uuid.uuid4()}{file_extension}"
         file_path = os.path.join(STATIC_DIR, filename)
-        logger.info(f"Saving uploaded image to: {file_path}")
 
-        file_content = file.file.read()
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
-        logger.info("Image saved successfully.")
+        # 先占用OCR并发名额再保存图片，被削峰（503）的请求不会在磁盘上留下图片
+        with ocr_slot():
+            with stage("save_image"):
+                file_content = file.file.read()
+                with open(file_path, "wb") as buffer:
+                    buffer.write(file_content)
 
-        image_url = f"{str(request.base_url).strip('/')}/static/images/{filename}"
-        logger.info(f"Image URL: {image_url}")
+            with stage("ocr"):
+                ocr_text_raw = recognize_text_from_image(file_path)
 
-        logger.info("Calling OCR service...")
-        ocr_text_raw = recognize_text_from_image(file_path)
+        image_url = f"{str(request.base_url).strip('/')}/static/images/{filename}"
         if isinstance(ocr_text_raw, bytes):
             ocr_text = ocr_text_raw.decode('utf-8', errors='ignore')
         else:
             ocr_text = ocr_text_raw
-        logger.info(f"OCR service returned text: {ocr_text[:100]}...")
+        logger.debug("OCR service returned text: %.100s", ocr_text)
 
-        logger.info("Parsing nutrition info...")
-        parsed_info = parse_nutrition_info(ocr_text)
+        with stage("parse"):
+            parsed_info = parse_nutrition_info(ocr_text)
         if not parsed_info:
             logger.error("Failed to parse nutrition info from OCR text.")
             raise HTTPException(status_code=422, detail="Could not parse nutrition info from image.")
-        logger.info(f"Parsed nutrition info: {parsed_info}")
 
-        logger.info("Analyzing nutrients...")
-        analysis_result = analyze_nutrients(parsed_info)
-        logger.info("Nutrient analysis successful.")
+        with stage("analyze"):
+            analysis_result = analyze_nutrients(parsed_info)
 
-        logger.info("Saving analysis to history...")
         import json
         history_data = schemas.AnalysisHistoryCreate(
             image_url=image_url,
             result_json=json.dumps(analysis_result, ensure_ascii=False)
         )
-        crud.create_analysis_history(db=db, history=history_data, user_id=user_id)
-        logger.info("Analysis saved to history successfully.")
+        with stage("db_write"):
+            crud.create_analysis_history(db=db, history=history_data, user_id=user_id)
+        logger.info(
+            "Analyze request completed",
+            extra={
+                "user_id": user_id,
+                "image": filename,
+                "nutrients": len(parsed_info),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            },
+        )
 
         return analysis_result
 
     except HTTPException as e:
-        logger.error(f"HTTPException in /analyze: {e.detail}")
+        logger.error("HTTPException in /analyze: %s", e.detail, extra={"user_id": user_id})
         raise e
     except Exception as e:
-        logger.error(f"An unexpected error occurred in /analyze: {e}", exc_info=True)
+        logger.error("An unexpected error occurred in /analyze: %s", e, exc_info=True, extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
     finally:
         # For simplicity, we are not cleaning up the image file to be able to show it in history.
@@ -0,0 +1,245 @@
+"""
+日志子系统：基于队列的非阻塞处理器 + 结构化JSON日志。
+
+- 业务线程只负责把日志记录放入内存队列，格式化和磁盘写入由后台 QueueListener 线程完成；
+- 每条记录都带有当前请求的 request_id；
+- 详细载荷日志（extra={"payload": True}）按 LOG_PAYLOAD_SAMPLE_RATE 采样。
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import IO, Optional, Tuple
+
+from config.production import config
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发只有单个进程，不需要区分 worker
+    fcntl = None
+
+# 当前请求的ID，由 RequestIdMiddleware 设置
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# LogRecord 的标准属性，其余属性视为通过 extra 传入的结构化字段
+_RESERVED_ATTRS = frozenset(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys()
+) | {"message", "asctime", "request_id", "payload"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# worker 编号的上限，远大于实际的 worker 数
+_MAX_WORKER_SLOTS = 64
+
+# 当前进程占用的 worker 编号及其锁文件，进程退出时锁自动释放
+_worker_slot: Optional[int] = None
+_worker_slot_lock: Optional[IO] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志记录格式化为单行JSON。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # 经过 LazyQueueHandler 的记录已在调用线程中渲染好异常堆栈
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """在调用线程中为日志记录附加 request_id。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class PayloadSamplingFilter(logging.Filter):
+    """按采样率丢弃标记为 payload 的详细日志，其余日志原样放行。"""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "payload", False):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+
+# 只用于在调用线程中渲染异常堆栈
+_exc_formatter = logging.Formatter()
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    标准 QueueHandler 会在调用线程中格式化消息；这里保留 msg/args 原样入队，
+    把字符串拼接推迟到后台线程。因此日志参数是在后台线程中渲染的，
+    调用 logger 之后不能再修改作为参数传入的对象（dict、SDK 模型等），否则记录的是修改后的状态。
+
+    异常堆栈仍在调用线程中渲染为 exc_text 并清除 exc_info，避免异常的栈帧在队列中一直存活。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def payload_enabled(logger: logging.Logger) -> bool:
+    """
+    判断是否需要构造详细载荷日志。采样率为0或 INFO 未开启时，调用方可以完全跳过
+    载荷的准备工作；是否真正写出由 PayloadSamplingFilter 决定。
+    """
+    return config.LOG_PAYLOAD_SAMPLE_RATE > 0 and logger.isEnabledFor(logging.INFO)
+
+
+def claim_worker_slot(root: str) -> Tuple[int, Optional[IO]]:
+    """
+    占用第一个空闲的 worker 编号，返回 (编号, 锁文件)；关闭锁文件即释放编号。
+    编号通过对 {root}.{编号}.lock 加排他锁实现，worker 重启后会复用退出进程留下的编号。
+    """
+    if fcntl is None:
+        return 0, None
+    for slot in range(_MAX_WORKER_SLOTS):
+        lock_file = open(f"{root}.{slot}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        return slot, lock_file
+    raise OSError(f"No free log slot for {root}")
+
+
+def worker_log_file() -> str:
+    """
+    当前进程的日志文件路径：在 LOG_FILE 的文件名后加上 worker 编号，例如 app.0.log。
+    多个 uvicorn worker 各自轮转同一个文件会相互覆盖或丢失日志，因此每个 worker 单独写一个文件；
+    编号而不是进程号保证重启和重新部署后沿用同一组文件，磁盘占用不超过
+    worker 数 × (LOG_BACKUP_COUNT + 1) × LOG_MAX_BYTES。
+    """
+    global _worker_slot, _worker_slot_lock
+    root, ext = os.path.splitext(config.LOG_FILE)
+    if _worker_slot is None:
+        _worker_slot, _worker_slot_lock = claim_worker_slot(root)
+    return f"{root}.{_worker_slot}{ext}"
+
+
+def _build_file_handler() -> Optional[logging.Handler]:
+    try:
+        os.makedirs(os.path.dirname(config.LOG_FILE) or ".", exist_ok=True)
+        return logging.handlers.RotatingFileHandler(
+            worker_log_file(),
+            maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUP_COUNT,
+            encoding="utf-8",
+        )
+    except OSError:
+        # 本地开发环境通常没有 /app/logs，退回到只输出到控制台
+        return None
+
+
+def setup_logging() -> None:
+    """配置根日志记录器。重复调用是安全的。"""
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter()
+    handlers = [logging.StreamHandler()]
+    file_handler = _build_file_handler()
+    if file_handler is not None:
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(PayloadSamplingFilter(config.LOG_PAYLOAD_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config.LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+
+    if file_handler is None:
+        logging.getLogger(__name__).warning(
+            "Log file %s is not writable, logging to console only", config.LOG_FILE
+        )
+
+
+def shutdown_logging() -> None:
+    """停止后台线程并把队列中剩余的日志写出。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_header(scope, name: str) -> Optional[str]:
+    """从ASGI scope中读取请求头（不区分大小写），不存在时返回 None。"""
+    key = name.lower().encode("latin-1")
+    for header, value in scope.get("headers", []):
+        if header == key:
+            return value.decode("latin-1")
+    return None
+
+
+class RequestIdMiddleware:
+    """
+    为每个HTTP请求生成（或沿用客户端传入的）request_id，并写回响应头。
+    使用纯ASGI实现，避免 BaseHTTPMiddleware 的额外开销。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = (get_header(scope, REQUEST_ID_HEADER) or "")[:64] or uuid.uuid4().hex
+
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((REQUEST_ID_HEADER.lower().encode("latin-1"), request_id.encode("latin-1")))
+                message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
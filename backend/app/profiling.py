@@ -0,0 +1,442 @@
+"""
+按需的单请求性能剖析与慢请求捕获。
+
+- 每个请求都会记录各阶段（stage）的耗时，开销只有几次 perf_counter 调用；
+- 后台采样线程定期抓取请求的调用栈（同步接口所在的线程池线程，以及负责表单解析和调度的
+  事件循环线程；请求在线程池中执行或事件循环空闲等待时不采事件循环线程，避免混入空闲时间和
+  其他请求的工作），只对以下请求采样：
+  * 携带 X-Profile 头且 X-Admin-Token 正确的请求；
+  * 按 PROFILE_SAMPLE_RATE 随机抽中的请求；
+  * 已运行超过慢请求阈值一半、可能成为慢请求的请求；
+- 被剖析或超过 PROFILE_SLOW_THRESHOLD_MS 的请求会把阶段时间线和折叠格式
+  （flamegraph.pl / speedscope 可直接读取）的调用栈写入有上限的磁盘环形缓冲区。
+  随机抽中的请求（reason=sampled）写入单独的环形缓冲区，数量上限为 PROFILE_MAX_SAMPLED_CAPTURES，
+  不会挤掉慢请求和显式请求的捕获。
+"""
+
+import asyncio
+import functools
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import anyio
+from fastapi.routing import APIRoute
+
+from config.production import config
+from app.logging_config import get_header, request_id_var
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Profile"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+_CAPTURE_ID_RE = re.compile(r"^[0-9T]+-[0-9]{4}Z-[0-9a-f]{8}$")
+_MAX_STACK_DEPTH = 64
+_EVENT_LOOP_FRAME = "[event loop]"
+_SAMPLED_SUBDIR = "sampled"
+
+# 同一毫秒内创建的捕获按顺序编号，保证捕获ID按创建时间排序
+_capture_counter = itertools.count()
+
+current_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("current_profile", default=None)
+
+
+def is_admin_token(token: Optional[str]) -> bool:
+    """校验管理令牌。未配置 ADMIN_TOKEN 时所有特权功能都被禁用。"""
+    if not config.ADMIN_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), config.ADMIN_TOKEN.encode("utf-8"))
+
+
+def _new_capture_id() -> str:
+    """
+    生成形如 20260101T120000123-0042Z-1a2b3c4d 的捕获ID：毫秒时间戳和进程内计数器保证按创建顺序排序，
+    随机后缀避免多个 worker 之间冲突。
+    """
+    now = datetime.now(timezone.utc)
+    sequence = next(_capture_counter) % 10000
+    return f"{now.strftime('%Y%m%dT%H%M%S')}{now.microsecond // 1000:03d}-{sequence:04d}Z-{uuid.uuid4().hex[:8]}"
+
+
+class RequestProfile:
+    """单个请求的阶段时间线和调用栈样本。"""
+
+    def __init__(self, method: str, path: str, reason: Optional[str] = None):
+        self.capture_id = _new_capture_id()
+        self.method = method
+        self.path = path
+        # "requested"（X-Profile）或 "sampled"（随机抽中）时从请求开始就采样
+        self.reason = reason
+        self.explicit = reason is not None
+        self.request_id = request_id_var.get()
+        self.started = time.perf_counter()
+        self.stages: List[Dict] = []
+        self.threads = set()
+        self.loop_thread: Optional[int] = None
+        self.samples: Counter = Counter()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def to_dict(self, status_code: int, duration_ms: float, reason: str, error: Optional[str] = None) -> Dict:
+        return {
+            "id": self.capture_id,
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "duration_ms": round(duration_ms, 1),
+            "reason": reason,
+            "error": error,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "sample_interval_ms": _sample_interval_ms(),
+            "stages": self.stages,
+            "stacks": [f"{stack} {count}" for stack, count in self.samples.most_common()],
+        }
+
+
+@contextmanager
+def _bind_thread(profile: RequestProfile):
+    """在代码块执行期间把当前线程登记为该请求的采样目标，结束后移除，避免线程被复用后误计。"""
+    thread_id = threading.get_ident()
+    if thread_id in profile.threads:
+        yield
+        return
+    profile.threads.add(thread_id)
+    try:
+        yield
+    finally:
+        profile.threads.discard(thread_id)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    记录一个处理阶段的耗时，并把当前线程登记为该请求的采样目标。
+    没有正在记录的请求时不做任何事。
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        with _bind_thread(profile):
+            yield
+    finally:
+        end = time.perf_counter()
+        profile.stages.append({
+            "name": name,
+            "start_ms": round((start - profile.started) * 1000, 1),
+            "duration_ms": round((end - start) * 1000, 1),
+        })
+
+
+class ProfiledRoute(APIRoute):
+    """
+    在同步接口执行的整个过程中把线程池线程登记为采样目标，
+    这样没有划分 stage 的接口也能采到调用栈。用法：APIRouter(route_class=ProfiledRoute)。
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = _profiled_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _profiled_endpoint(endpoint):
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        with _bind_thread(profile):
+            return endpoint(*args, **kwargs)
+    return wrapper
+
+
+def _sample_interval_ms() -> int:
+    # 间隔为0或负数时采样线程会空转占满一个核，至少间隔 1ms
+    return max(1, config.PROFILE_INTERVAL_MS)
+
+
+def _is_idle_loop(frame) -> bool:
+    # 事件循环空闲时阻塞在 selectors 的 select() 中等待IO
+    code = frame.f_code
+    return code.co_name == "select" and os.path.basename(code.co_filename) == "selectors.py"
+
+
+def _format_stack(frame) -> str:
+    frames = []
+    while frame is not None and len(frames) < _MAX_STACK_DEPTH:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class StackSampler:
+    """后台采样线程，只在存在需要采样的请求时才调用 sys._current_frames()。"""
+
+    def __init__(self, interval_ms: int, slow_threshold_ms: int):
+        self.interval = interval_ms / 1000
+        # 运行超过阈值一半的请求开始采样，这样慢请求也能带上调用栈
+        self.speculative_after_ms = slow_threshold_ms / 2 if slow_threshold_ms > 0 else None
+        self._active = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def register(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._active.add(profile)
+
+    def unregister(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._active.discard(profile)
+
+    def _wants_samples(self, profile: RequestProfile) -> bool:
+        if profile.explicit:
+            return True
+        return self.speculative_after_ms is not None and profile.elapsed_ms() >= self.speculative_after_ms
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                targets = [p for p in self._active if self._wants_samples(p)]
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            for profile in targets:
+                threads = list(profile.threads)
+                for thread_id in threads:
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.samples[_format_stack(frame)] += 1
+                if threads:
+                    # 请求正在线程池中执行，事件循环此时做的是其他请求的工作
+                    continue
+                # 事件循环线程由所有请求共享，单独加一层根帧以便在火焰图中区分
+                frame = frames.get(profile.loop_thread)
+                if frame is not None and not _is_idle_loop(frame):
+                    profile.samples[f"{_EVENT_LOOP_FRAME};{_format_stack(frame)}"] += 1
+            del frames
+
+
+class CaptureStore:
+    """
+    磁盘上的环形缓冲区，最多保留 max_captures 个捕获文件，超出时按捕获ID（即创建时间）删除最旧的，
+    但不会删除刚写入的文件。随机抽样的捕获保存在 sampled 子目录中，单独按 max_sampled 计数。
+    """
+
+    def __init__(self, directory: str, max_captures: int, max_sampled: int = 0):
+        self.directory = directory
+        self.sampled_directory = os.path.join(directory, _SAMPLED_SUBDIR)
+        self.max_captures = max_captures
+        self.max_sampled = max_sampled
+        self._lock = threading.Lock()
+        if max_sampled > 0:
+            os.makedirs(self.sampled_directory, exist_ok=True)
+
+    def _directories(self) -> List[str]:
+        return [self.directory, self.sampled_directory]
+
+    def _ring(self, reason: str):
+        if reason == "sampled":
+            return self.sampled_directory, self.max_sampled
+        return self.directory, self.max_captures
+
+    @staticmethod
+    def _names(directory: str) -> List[str]:
+        try:
+            return [n for n in os.listdir(directory) if n.endswith(".json")]
+        except FileNotFoundError:
+            return []
+
+    def save(self, capture: Dict) -> None:
+        directory, max_captures = self._ring(capture["reason"])
+        if max_captures < 1:
+            return
+        saved_name = f"{capture['id']}.json"
+        with self._lock:
+            tmp_path = os.path.join(directory, saved_name + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(capture, f, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(directory, saved_name))
+
+            names = sorted(n for n in self._names(directory) if n != saved_name)
+            for name in names[:max(0, len(names) + 1 - max_captures)]:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    # 其他 worker 已经删除
+                    pass
+
+    def list(self) -> List[Dict]:
+        summaries = []
+        names = sorted((n for directory in self._directories() for n in self._names(directory)), reverse=True)
+        for name in names:
+            capture = self.load(name[:-len(".json")])
+            if capture is None:
+                continue
+            capture.pop("stages", None)
+            samples = sum(int(line.rsplit(" ", 1)[1]) for line in capture.pop("stacks", []))
+            capture["samples"] = samples
+            summaries.append(capture)
+        return summaries
+
+    def load(self, capture_id: str) -> Optional[Dict]:
+        if not _CAPTURE_ID_RE.match(capture_id):
+            return None
+        for directory in self._directories():
+            try:
+                with open(os.path.join(directory, f"{capture_id}.json"), encoding="utf-8") as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError):
+                return None
+        return None
+
+
+_sampler: Optional[StackSampler] = None
+_store: Optional[CaptureStore] = None
+
+
+def setup_profiling() -> None:
+    """启动采样线程并准备捕获目录。重复调用是安全的。"""
+    global _sampler, _store
+    if _sampler is not None:
+        return
+    _store = None
+    if config.PROFILE_MAX_CAPTURES < 1:
+        logger.warning("PROFILE_MAX_CAPTURES is %s, captures are disabled", config.PROFILE_MAX_CAPTURES)
+    else:
+        try:
+            os.makedirs(config.PROFILE_DIR, exist_ok=True)
+            _store = CaptureStore(config.PROFILE_DIR, config.PROFILE_MAX_CAPTURES, config.PROFILE_MAX_SAMPLED_CAPTURES)
+        except OSError:
+            logger.warning("Profile directory %s is not writable, captures are disabled", config.PROFILE_DIR)
+    if config.PROFILE_INTERVAL_MS < 1:
+        logger.warning(
+            "PROFILE_INTERVAL_MS is %s, sampling every %sms instead", config.PROFILE_INTERVAL_MS, _sample_interval_ms()
+        )
+    _sampler = StackSampler(_sample_interval_ms(), config.PROFILE_SLOW_THRESHOLD_MS)
+    _sampler.start()
+
+
+def shutdown_profiling() -> None:
+    global _sampler, _store
+    if _sampler is not None:
+        _sampler.stop()
+        _sampler = None
+    _store = None
+
+
+def get_capture_store() -> Optional[CaptureStore]:
+    return _store
+
+
+class ProfilingMiddleware:
+    """
+    为每个HTTP请求建立 RequestProfile，按需采样，并在请求结束后决定是否写入捕获文件。
+    需要放在 RequestIdMiddleware 之内（即先于它注册），以便记录 request_id。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or _sampler is None:
+            await self.app(scope, receive, send)
+            return
+
+        reason = None
+        if get_header(scope, PROFILE_HEADER) == "1" and is_admin_token(get_header(scope, ADMIN_TOKEN_HEADER)):
+            reason = "requested"
+        elif config.PROFILE_SAMPLE_RATE > 0 and random.random() < config.PROFILE_SAMPLE_RATE:
+            reason = "sampled"
+        profile = RequestProfile(scope["method"], scope["path"], reason)
+        profile.loop_thread = threading.get_ident()
+        status_code = 500
+        error = None
+
+        async def send_with_profile(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if reason == "requested" and _store is not None:
+                    headers = list(message.get("headers", []))
+                    headers.append((PROFILE_ID_HEADER.lower().encode("latin-1"), profile.capture_id.encode("latin-1")))
+                    message["headers"] = headers
+            await send(message)
+
+        token = current_profile.set(profile)
+        sampler = _sampler
+        sampler.register(profile)
+        try:
+            await self.app(scope, receive, send_with_profile)
+        except Exception as exc:
+            # 先保存捕获再重新抛出：出错的慢请求正是最需要分析的
+            error = exc
+        finally:
+            sampler.unregister(profile)
+            current_profile.reset(token)
+
+        await self._save(profile, status_code, error)
+        if error is not None:
+            raise error
+
+    async def _save(self, profile: RequestProfile, status_code: int, error: Optional[Exception]) -> None:
+        duration_ms = profile.elapsed_ms()
+        threshold = config.PROFILE_SLOW_THRESHOLD_MS
+        if profile.reason == "requested":
+            reason = "requested"
+        elif threshold > 0 and duration_ms >= threshold:
+            reason = "slow"
+        elif profile.reason == "sampled":
+            reason = "sampled"
+        else:
+            return
+        store = _store
+        if store is None:
+            return
+
+        capture = profile.to_dict(status_code, duration_ms, reason, repr(error) if error is not None else None)
+        try:
+            # 响应已经发出，把磁盘写入放到线程池中，避免阻塞事件循环
+            await anyio.to_thread.run_sync(store.save, capture)
+        except OSError:
+            logger.error("Failed to save profile capture %s", profile.capture_id, exc_info=True)
+        else:
+            logger.info(
+                "Saved profile capture",
+                extra={"capture_id": profile.capture_id, "reason": reason, "duration_ms": round(duration_ms, 1)},
+            )
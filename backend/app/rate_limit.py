@@ -0,0 +1,298 @@
+"""
+令牌桶限流。
+
+每个请求都计入客户端IP的令牌桶；携带有效会话令牌（见 app.security）时还会计入该用户的令牌桶，
+防止同一账号换IP绕过限流。每个键有“每分钟”和“每小时”两个桶，容量分别为
+RATE_LIMIT_PER_MINUTE / RATE_LIMIT_PER_HOUR，按比例匀速补充，限额为0的桶不生效。
+一次请求需要所有桶各取走一个令牌，检查和扣减是原子的：
+
+- MemoryBucketStore：进程内存储，单 worker 部署或测试时使用，多 worker 时每个进程各自计数；
+- RedisBucketStore：多 worker / 多实例共享的 Redis 兼容存储，通过 Lua 脚本保证原子性。
+
+ConcurrencyLimiter 用于限制对外部服务（阿里云OCR）的并发调用数。
+"""
+
+import ipaddress
+import json
+import logging
+import math
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+
+from config.production import config
+from app.logging_config import get_header
+from app.security import SESSION_HEADER, verify_session_token
+
+logger = logging.getLogger(__name__)
+
+# (桶名, 容量, 每秒补充的令牌数)
+Bucket = Tuple[str, float, float]
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# 不参与限流的路径前缀
+_EXEMPT_PREFIXES = ("/api/admin",)
+
+# Redis 不可用时，告警日志最多每隔这么多秒输出一次
+_STORE_WARNING_INTERVAL = 60
+
+
+def default_buckets() -> List[Bucket]:
+    """按配置生成令牌桶，限额为0（或负数）的时间窗口不限流。"""
+    buckets = []
+    for name, limit, seconds in (
+        ("minute", config.RATE_LIMIT_PER_MINUTE, 60),
+        ("hour", config.RATE_LIMIT_PER_HOUR, 3600),
+    ):
+        if limit > 0:
+            buckets.append((name, limit, limit / seconds))
+    return buckets
+
+
+class MemoryBucketStore:
+    """
+    进程内令牌桶存储。只在事件循环线程中调用且 take() 内部没有 await，
+    因此天然是原子的。
+    """
+
+    # 超过该数量时清理已补满（长时间未访问）的桶
+    MAX_KEYS = 10000
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def take(self, keys: List[str], buckets: List[Bucket]) -> Tuple[bool, float]:
+        """尝试从每个键的所有桶中各取一个令牌，返回 (是否放行, 需要等待的秒数)。"""
+        now = self._clock()
+        states = []
+        retry_after = 0.0
+        for key in keys:
+            for name, capacity, rate in buckets:
+                bucket_key = f"{key}:{name}"
+                tokens, updated = self._buckets.get(bucket_key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                states.append((bucket_key, tokens))
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+
+        allowed = retry_after == 0
+        for bucket_key, tokens in states:
+            self._buckets[bucket_key] = (tokens - 1 if allowed else tokens, now)
+
+        if len(self._buckets) > self.MAX_KEYS:
+            self._prune(now, buckets)
+        return allowed, retry_after
+
+    def _prune(self, now: float, buckets: List[Bucket]) -> None:
+        # 最慢的桶从空到满所需的时间，超过这段时间未访问的桶一定已经补满
+        idle = max(capacity / rate for _, capacity, rate in buckets)
+        for bucket_key, (_, updated) in list(self._buckets.items()):
+            if now - updated > idle:
+                del self._buckets[bucket_key]
+
+
+# KEYS: 各个桶的键；ARGV: 依次为每个桶的容量和每秒补充速率
+# 使用 Redis 服务器时间，避免多台机器之间的时钟偏差
+_TAKE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local value = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    value = math.min(capacity, value + math.max(0, now - ts) * rate)
+    tokens[i] = value
+    if value < 1 then
+        retry_after = math.max(retry_after, (1 - value) / rate)
+    end
+end
+local allowed = retry_after == 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = tonumber(ARGV[i * 2])
+    local value = tokens[i]
+    if allowed then value = value - 1 end
+    redis.call('HSET', key, 'tokens', tostring(value), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {allowed and 1 or 0, tostring(retry_after)}
+"""
+
+
+class RedisBucketStore:
+    """
+    基于 Redis 兼容服务的共享令牌桶存储。redis 客户端在第一次使用时才导入。
+    Redis 不可用时退回到进程内的 MemoryBucketStore（限额按 worker 计算），
+    既不让限流组件本身成为故障点，也不会完全放开限流。
+    """
+
+    def __init__(self, url: str, prefix: str = "ratelimit", client=None):
+        self.url = url
+        self.prefix = prefix
+        self._client = client
+        self._script = None
+        self._last_warning: Optional[float] = None
+        self._fallback = MemoryBucketStore()
+
+    def _get_script(self):
+        if self._script is None:
+            if self._client is None:
+                import redis.asyncio as redis
+
+                self._client = redis.Redis.from_url(self.url)
+            self._script = self._client.register_script(_TAKE_SCRIPT)
+        return self._script
+
+    def _warn_unavailable(self) -> None:
+        # Redis 故障期间每个请求都会失败，限制告警频率，避免刷屏
+        now = time.monotonic()
+        if self._last_warning is None or now - self._last_warning >= _STORE_WARNING_INTERVAL:
+            self._last_warning = now
+            logger.warning("Rate limit store unavailable, falling back to per-process limits", exc_info=True)
+
+    async def take(self, keys: List[str], buckets: List[Bucket]) -> Tuple[bool, float]:
+        redis_keys = [f"{self.prefix}:{key}:{name}" for key in keys for name, _, _ in buckets]
+        args = []
+        for _ in keys:
+            for _, capacity, rate in buckets:
+                args.extend([capacity, rate])
+        try:
+            allowed, retry_after = await self._get_script()(keys=redis_keys, args=args)
+        except Exception:
+            self._warn_unavailable()
+            return await self._fallback.take(keys, buckets)
+        self._last_warning = None
+        return bool(allowed), float(retry_after)
+
+
+def create_store():
+    if config.RATE_LIMIT_STORAGE == "redis":
+        return RedisBucketStore(config.REDIS_URL)
+    return MemoryBucketStore()
+
+
+def _is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in _trusted_networks())
+
+
+@lru_cache(maxsize=1)
+def _networks(proxies: Tuple[str, ...]) -> List[IPNetwork]:
+    return [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+
+
+def _trusted_networks() -> List[IPNetwork]:
+    return _networks(tuple(config.RATE_LIMIT_TRUSTED_PROXIES))
+
+
+def client_keys(scope) -> List[str]:
+    """
+    返回本次请求要计数的限流键：总是包含客户端IP；只有会话令牌校验通过时才加上 user_id，
+    客户端自行声明的 user_id（表单、路径）不可信，不参与限流。
+    """
+    peer = scope["client"][0] if scope.get("client") else None
+    ip = peer
+    if peer and _is_trusted_proxy(peer):
+        # 由 nginx 设置为 $remote_addr；直连的客户端可以随意伪造，因此只信任代理转发的请求
+        ip = get_header(scope, "X-Real-IP") or peer
+    keys = [f"ip:{ip or 'unknown'}"]
+
+    user_id = verify_session_token(get_header(scope, SESSION_HEADER))
+    if user_id:
+        keys.append(f"user:{user_id}")
+    return keys
+
+
+async def send_error(send, status_code: int, detail: str, retry_after: float) -> None:
+    """直接发送带 Retry-After 头的JSON错误响应。"""
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode("latin-1")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """对 /api 下的请求按客户端执行令牌桶限流，超限时返回 429 和 Retry-After。"""
+
+    def __init__(self, app, store=None, buckets: Optional[List[Bucket]] = None):
+        self.app = app
+        self.store = store if store is not None else create_store()
+        self.buckets = buckets if buckets is not None else default_buckets()
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] != "http"
+            or not config.RATE_LIMIT_ENABLED
+            or not self.buckets
+            or not path.startswith("/api/")
+            or path.startswith(_EXEMPT_PREFIXES)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        keys = client_keys(scope)
+        allowed, retry_after = await self.store.take(keys, self.buckets)
+        if not allowed:
+            logger.warning("Rate limit exceeded", extra={"client": keys, "retry_after": round(retry_after, 1)})
+            await send_error(send, 429, "Too many requests", retry_after)
+            return
+        await self.app(scope, receive, send)
+
+
+class ConcurrencyLimiter:
+    """
+    限制同时进行的调用数量。没有空闲名额时最多允许 queue_size 个调用排队等待，
+    队列已满或等待超过 timeout 秒时抛出 503 并带上 Retry-After，实现削峰。
+    """
+
+    def __init__(self, max_concurrency: int, queue_size: int, timeout: float):
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._queue_size = queue_size
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def _overloaded(self) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="Service is busy, please retry later.",
+            headers={"Retry-After": str(max(1, math.ceil(self.timeout)))},
+        )
+
+    def acquire(self) -> None:
+        if self._semaphore.acquire(blocking=False):
+            return
+        with self._lock:
+            if self._waiting >= self._queue_size:
+                raise self._overloaded()
+            self._waiting += 1
+        try:
+            acquired = self._semaphore.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if not acquired:
+            raise self._overloaded()
+
+    def release(self) -> None:
+        self._semaphore.release()
@@ -0,0 +1,41 @@
+"""
+会话令牌：/api/login 签发，客户端在 X-Session-Token 请求头中携带。
+
+令牌格式为 "<user_id>.<过期时间戳>.<签名>"，签名是以 SECRET_KEY 为密钥的 HMAC-SHA256，
+服务端无需存储即可验证 user_id 确实来自登录接口。
+"""
+
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+from config.production import config
+
+SESSION_HEADER = "X-Session-Token"
+
+
+def _sign(payload: str) -> str:
+    return hmac.new(config.SECRET_KEY.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def create_session_token(user_id: str) -> str:
+    """为登录用户签发会话令牌。"""
+    payload = f"{user_id}.{int(time.time()) + config.SESSION_MAX_AGE}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_session_token(token: Optional[str]) -> Optional[str]:
+    """校验会话令牌，有效时返回 user_id，签名错误、格式错误或已过期时返回 None。"""
+    if not token:
+        return None
+    try:
+        user_id, expires, signature = token.rsplit(".", 2)
+        expired = int(expires) < time.time()
+    except ValueError:
+        return None
+    if expired or not user_id:
+        return None
+    if not hmac.compare_digest(signature.encode("utf-8"), _sign(f"{user_id}.{expires}").encode("utf-8")):
+        return None
+    return user_id
@@ -1,15 +1,14 @@
 import os
 import asyncio
-from dotenv import load_dotenv
-
-load_dotenv()
-from alibabacloud_ocr_api20210707.client import Client as OcrClient
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_ocr_api20210707 import models as ocr_models
-from alibabacloud_tea_util import models as util_models
 import io
 import logging
 import json
+import threading
+from contextlib import contextmanager
+
+from config.production import config
+from app.logging_config import payload_enabled
+from app.rate_limit import ConcurrencyLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -27,27 +26,75 @@ logger = logging.getLogger(__name__)
 # 验证环境变量是否设置成功:
 # echo $env:ALIYUN_ACCESS_KEY_ID
 
-ACCESS_KEY_ID = os.environ.get("ALIYUN_ACCESS_KEY_ID")
-ACCESS_KEY_SECRET = os.environ.get("ALIYUN_ACCESS_KEY_SECRET")
 # OCR API的地域接入点，请根据您的位置选择，例如华东（上海）为 ocr-cn-shanghai.aliyuncs.com
 OCR_ENDPOINT = "ocr-cn-shanghai.aliyuncs.com"
 
-if not all([ACCESS_KEY_ID, ACCESS_KEY_SECRET]):
-    raise ValueError("环境变量 ALIYUN_ACCESS_KEY_ID 和 ALIYUN_ACCESS_KEY_SECRET 未设置")
+# 模拟的OCR识别结果，用于网络故障时的备用方案、测试和启动预热
+MOCK_OCR_TEXT = """
+营养成分表
+项目         每100克   营养素参考值%
+能量         1800千焦   21%
+蛋白质       8.0克      13%
+脂肪         15.0克     25%
+碳水化合物   60.0克     20%
+钠           600毫克    30%
+"""
+
+# 阿里云SDK体积较大，延迟到第一次使用（或应用启动阶段）再导入并创建客户端
+_client = None
+_client_lock = threading.Lock()
+
+# 限制每个 worker 同时发出的OCR请求数，避免占满阿里云的QPS配额
+_ocr_limiter = ConcurrencyLimiter(config.OCR_MAX_CONCURRENCY, config.OCR_QUEUE_SIZE, config.OCR_QUEUE_TIMEOUT)
+
+
+def init_ocr_client():
+    """
+    导入阿里云SDK并创建OCR客户端，结果会被缓存复用。
+    密钥未配置时返回 None，由调用方决定如何处理。
+    """
+    global _client
+    if _client is not None:
+        return _client
 
-def recognize_text_from_image(file_path: str) -> str:
     access_key_id = os.environ.get("ALIYUN_ACCESS_KEY_ID")
     access_key_secret = os.environ.get("ALIYUN_ACCESS_KEY_SECRET")
-
     if not access_key_id or not access_key_secret:
+        return None
+
+    with _client_lock:
+        if _client is None:
+            from alibabacloud_ocr_api20210707.client import Client as OcrClient
+            from alibabacloud_tea_openapi import models as open_api_models
+
+            client_config = open_api_models.Config(
+                access_key_id=access_key_id,
+                access_key_secret=access_key_secret
+            )
+            client_config.endpoint = OCR_ENDPOINT
+            _client = OcrClient(client_config)
+    return _client
+
+@contextmanager
+def ocr_slot():
+    """
+    占用一个OCR并发名额，超出并发上限且排队已满或超时时抛出 503。
+    调用方应在保存上传文件之前占用名额，被削峰的请求就不会写盘；
+    recognize_text_from_image 必须在名额内调用。
+    """
+    _ocr_limiter.acquire()
+    try:
+        yield
+    finally:
+        _ocr_limiter.release()
+
+def recognize_text_from_image(file_path: str) -> str:
+    client = init_ocr_client()
+    if client is None:
         return "错误：阿里云访问密钥未配置。"
 
-    config = open_api_models.Config(
-        access_key_id=access_key_id,
-        access_key_secret=access_key_secret
-    )
-    config.endpoint = OCR_ENDPOINT
-    client = OcrClient(config)
+    from alibabacloud_ocr_api20210707 import models as ocr_models
+    from alibabacloud_tea_util import models as util_models
 
     with open(file_path, 'rb') as f:
         file_content = f.read()
@@ -61,13 +108,13 @@ def recognize_text_from_image(file_path: str) -> str:
 
     try:
         response = client.recognize_general_with_options(request, runtime)
-        logger.info(f"OCR API response status: {response.status_code}")
-        logger.info(f"OCR API response body: {response.body}")
+        logger.debug("OCR API response status: %s", response.status_code)
+        # 完整响应体体积较大，仅按采样率记录
+        if payload_enabled(logger):
+            logger.info("OCR API response body: %s", response.body, extra={"payload": True})
         # 根据实际的OCR API返回格式进行调整
         if response.status_code == 200 and response.body and response.body.data:
             data_str = response.body.data
-            logger.info(f"OCR response data type: {type(data_str)}")
-            logger.info(f"OCR response data content: {data_str}")
             data_json = json.loads(data_str)
             content = data_json.get('content', '')
             if isinstance(content, list):
@@ -75,35 +122,19 @@ def recognize_text_from_image(file_path: str) -> str:
             return content
         else:
             message = response.body.message if response.body else "Unknown error"
-            logger.error(f"OCR API error: {message}")
+            logger.error("OCR API error: %s", message, extra={"status_code": response.status_code})
             return f"OCR识别失败：{message}"
     except Exception as e:
-        logger.error(f"Exception during OCR call: {e}", exc_info=True)
+        logger.error("Exception during OCR call: %s", e, exc_info=True)
         # 如果是网络连接问题，使用模拟数据作为备用方案
         if "Failed to resolve" in str(e) or "NameResolutionError" in str(e) or "HTTPSConnectionPool" in str(e):
             logger.warning("网络连接失败，使用模拟OCR数据作为备用方案")
-            return """
-营养成分表
-项目         每100克   营养素参考值%
-能量         1800千焦   21%
-蛋白质       8.0克      13%
-脂肪         15.0克     25%
-碳水化合物   60.0克     20%
-钠           600毫克    30%
-"""
-        return f"OCR识别失败：{e}"  
+            return MOCK_OCR_TEXT
+        return f"OCR识别失败：{e}"
 
 async def recognize_text_from_image_mock(image_bytes: bytes) -> str:
     """
     模拟OCR识别，保留用于快速测试或在没有网络连接时使用。
     """
     await asyncio.sleep(0.1)
-    return """
-    营养成分表
-    项目         每100克   营养素参考值%
-    能量         1800千焦   21%
-    蛋白质       8.0克      13%
-    脂肪         15.0克     25%
-    碳水化合物   60.0克     20%
-    钠           600毫克    30%
-    """
\ No newline at end of file
+    return MOCK_OCR_TEXT
\ No newline at end of file
@@ -12,6 +12,8 @@ class ProductionConfig:
     
     # 🔐 安全配置
     SECRET_KEY: str = os.getenv('SECRET_KEY', 'your-super-secret-key-change-in-production')
+    # 会话令牌有效期（秒），用于 /api/login 签发的 X-Session-Token
+    SESSION_MAX_AGE: int = int(os.getenv('SESSION_MAX_AGE', str(30 * 24 * 3600)))
     DEBUG: bool = False
     TESTING: bool = False
     
@@ -40,15 +42,50 @@ class ProductionConfig:
     WECHAT_APP_SECRET: str = os.getenv('WECHAT_APP_SECRET', '')
     
     # 🚦 限流配置
-    RATE_LIMIT_ENABLED: bool = True
-    RATE_LIMIT_PER_MINUTE: int = 60
-    RATE_LIMIT_PER_HOUR: int = 1000
+    RATE_LIMIT_ENABLED: bool = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    # 每个客户端IP、以及每个持有有效会话令牌的用户各自的限额；0 表示该时间窗口不限流
+    RATE_LIMIT_PER_MINUTE: int = int(os.getenv('RATE_LIMIT_PER_MINUTE', '60'))
+    RATE_LIMIT_PER_HOUR: int = int(os.getenv('RATE_LIMIT_PER_HOUR', '1000'))
+    # 令牌桶存储：memory（进程内）或 redis（多 worker 共享，使用 REDIS_URL）。
+    # memory 按进程计数，整个服务的实际限额为上面的限额 × worker 数（Dockerfile 中 --workers 4）；
+    # redis 不可用时同样退回到按进程计数
+    RATE_LIMIT_STORAGE: str = os.getenv('RATE_LIMIT_STORAGE', 'memory')
+    # 受信任的反向代理地址（逗号分隔，支持 CIDR，如 nginx 容器的IP）。只有直连对端在此列表中时
+    # 才使用 X-Real-IP 识别客户端；留空则总是使用直连对端地址，防止绕过 nginx 直连时伪造该请求头
+    RATE_LIMIT_TRUSTED_PROXIES: list = [
+        proxy.strip() for proxy in os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '').split(',') if proxy.strip()
+    ]
+    # 每个 worker 进程同时进行的OCR调用上限，以及排队等待的请求数和最长等待秒数。
+    # 上限按进程计算，整个服务的实际上限为 OCR_MAX_CONCURRENCY × worker 数
+    # （Dockerfile 中 --workers 4，默认即 16 个并发），请按阿里云QPS配额相应设置
+    # 正在调用和排队的OCR请求都会占用线程池线程，两者之和不能超过线程池的一半，
+    # 否则 /login、/history 和健康检查会因没有空闲线程而阻塞
+    OCR_MAX_CONCURRENCY: int = int(os.getenv('OCR_MAX_CONCURRENCY', '4'))
+    OCR_QUEUE_SIZE: int = int(os.getenv('OCR_QUEUE_SIZE', '16'))
+    OCR_QUEUE_TIMEOUT: float = float(os.getenv('OCR_QUEUE_TIMEOUT', '10'))
+    # Starlette 执行同步接口所用的 anyio 默认线程池大小
+    THREADPOOL_SIZE: int = 40
     
     # 📊 日志配置
-    LOG_LEVEL: str = 'INFO'
-    LOG_FILE: str = '/app/logs/app.log'
-    LOG_MAX_BYTES: int = 10 * 1024 * 1024  # 10MB
-    LOG_BACKUP_COUNT: int = 5
+    LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
+    # 每个 worker 进程写入 LOG_FILE 加 worker 编号后缀的文件（如 app.0.log），各自按下面的设置轮转；
+    # 编号在重启后复用，总占用不超过 worker 数 × (LOG_BACKUP_COUNT + 1) × LOG_MAX_BYTES
+    LOG_FILE: str = os.getenv('LOG_FILE', '/app/logs/app.log')
+    LOG_MAX_BYTES: int = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))  # 10MB
+    LOG_BACKUP_COUNT: int = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+    # 详细载荷日志（如OCR原始响应）的采样率，0 表示关闭，1 表示全部记录
+    LOG_PAYLOAD_SAMPLE_RATE: float = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+    
+    # 🔬 性能剖析配置
+    # 管理令牌：用于 X-Profile 请求头和 /api/admin 接口，留空则禁用这些特权功能
+    ADMIN_TOKEN: str = os.getenv('ADMIN_TOKEN', '')
+    PROFILE_SAMPLE_RATE: float = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+    PROFILE_SLOW_THRESHOLD_MS: int = int(os.getenv('PROFILE_SLOW_THRESHOLD_MS', '3000'))  # 0 表示不捕获慢请求
+    PROFILE_INTERVAL_MS: int = int(os.getenv('PROFILE_INTERVAL_MS', '10'))
+    PROFILE_DIR: str = os.getenv('PROFILE_DIR', '/app/logs/profiles')
+    PROFILE_MAX_CAPTURES: int = int(os.getenv('PROFILE_MAX_CAPTURES', '50'))
+    # 按 PROFILE_SAMPLE_RATE 随机抽中的捕获单独保留的数量，不占用上面慢请求捕获的名额；0 表示不保存
+    PROFILE_MAX_SAMPLED_CAPTURES: int = int(os.getenv('PROFILE_MAX_SAMPLED_CAPTURES', '20'))
     
     # 🔄 Redis配置 (用于缓存和会话)
     REDIS_URL: str = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
@@ -95,5 +132,16 @@ class ProductionConfig:
         print("✅ 生产环境配置验证通过")
         return True
 
+    def validate_ocr_limits(self) -> None:
+        """检查OCR并发和排队上限没有占满线程池，配置错误时启动即失败。"""
+        if self.OCR_MAX_CONCURRENCY < 1 or self.OCR_QUEUE_SIZE < 0:
+            raise ValueError("OCR_MAX_CONCURRENCY 必须大于0，OCR_QUEUE_SIZE 不能为负数")
+        if self.OCR_MAX_CONCURRENCY + self.OCR_QUEUE_SIZE > self.THREADPOOL_SIZE // 2:
+            raise ValueError(
+                f"OCR_MAX_CONCURRENCY + OCR_QUEUE_SIZE = {self.OCR_MAX_CONCURRENCY + self.OCR_QUEUE_SIZE}，"
+                f"不能超过线程池大小 {self.THREADPOOL_SIZE} 的一半"
+            )
+
 # 配置实例
-config = ProductionConfig()
\ No newline at end of file
+config = ProductionConfig()
+config.validate_ocr_limits()
\ No newline at end of file
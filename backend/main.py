@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from dotenv import load_dotenv
 
@@ -5,15 +7,57 @@ from dotenv import load_dotenv
 load_dotenv()
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-from app.api.endpoints import router as api_router
+from app.api import admin, endpoints
 from app.database import engine, Base
+from app.logging_config import RequestIdMiddleware, setup_logging, shutdown_logging
+from app.profiling import ProfilingMiddleware, setup_profiling, shutdown_profiling
+from app.rate_limit import RateLimitMiddleware
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
+# 静态文件根目录
+STATIC_DIR = "static"
+
+
+def warm_up():
+    """
+    预热：提前导入阿里云SDK并创建OCR客户端，再用模拟OCR结果走一遍解析和分析流程，
+    避免第一个真实请求承担这些开销。模拟数据不消耗OCR调用额度。
+    """
+    from app.logic.analyzer import parse_nutrition_info, analyze_nutrients
+    from app.services.ocr_service import MOCK_OCR_TEXT, init_ocr_client
+
+    try:
+        if init_ocr_client() is None:
+            logger.warning("Aliyun OCR credentials are not configured, /api/analyze will fail")
+    except ImportError:
+        logger.error("Aliyun OCR SDK is not installed", exc_info=True)
+
+    analyze_nutrients(parse_nutrition_info(MOCK_OCR_TEXT))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动阶段：初始化日志和性能剖析、创建目录和数据库表、预热OCR客户端
+    setup_logging()
+    setup_profiling()
+    os.makedirs(endpoints.STATIC_DIR, exist_ok=True)
+    Base.metadata.create_all(bind=engine)
+    warm_up()
+    logger.info("Application startup complete")
+    yield
+    shutdown_profiling()
+    # 把队列中尚未写出的日志刷到磁盘
+    shutdown_logging()
+
+
 app = FastAPI(
     title="营养健康小程序后端",
     description="提供OCR识别和营养成分分析服务。",
     version="1.1.0",
+    lifespan=lifespan,
 )
 
 # 配置CORS
@@ -24,18 +68,13 @@ app.add_middleware(
     allow_methods=["*"],  # 允许所有HTTP方法
     allow_headers=["*"],  # 允许所有HTTP头
 )
+# 中间件按注册的逆序执行：RequestId -> Profiling -> RateLimit -> CORS -> 路由
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(RequestIdMiddleware)
 
-# 在应用启动时创建数据库表
-@app.on_event("startup")
-def on_startup():
-    Base.metadata.create_all(bind=engine)
-
-# 确保静态目录存在
-STATIC_DIR = "static"
-os.makedirs(STATIC_DIR, exist_ok=True)
-
-# 挂载静态文件目录
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+# 挂载静态文件目录（目录在 lifespan 中创建）
+app.mount("/static", StaticFiles(directory=STATIC_DIR, check_dir=False), name="static")
 
 @app.get("/", tags=["General"], summary="服务健康检查")
 def health_check():
@@ -44,8 +83,11 @@ def health_check():
     """
     return {"status": "ok", "message": "服务运行正常"}
 
-app.include_router(api_router, prefix="/api", tags=["Analysis"])
+app.include_router(endpoints.router, prefix="/api", tags=["Analysis"])
+app.include_router(admin.router, prefix="/api/admin", tags=["Admin"])
 
 if __name__ == "__main__":
+    import uvicorn
+
     # 启动服务，监听在 8000 端口
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -7,6 +7,8 @@ App({
     API_URL: 'http://192.168.11.101:8000',
     openid: null,
     userId: null,
+    // 登录接口签发的会话令牌，请求时放在 X-Session-Token 头中
+    sessionToken: null,
     // 定义一个回调函数，用于登录成功后通知页面
     userIdReadyCallback: null,
   },
@@ -27,6 +29,7 @@ App({
                 // 登录成功，静默处理
                 this.globalData.openid = loginRes.data.openid;
                 this.globalData.userId = loginRes.data.user_id;
+                this.globalData.sessionToken = loginRes.data.session_token;
                 // 如果有页面设置了回调函数，则执行
                 if (this.globalData.userIdReadyCallback) {
                   this.globalData.userIdReadyCallback(loginRes.data.user_id);
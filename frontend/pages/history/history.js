@@ -24,6 +24,9 @@ Page({
     wx.request({
       url: `${app.globalData.API_URL}/api/history/${userId}`,
       method: 'GET',
+      header: {
+        'X-Session-Token': app.globalData.sessionToken
+      },
       success: (res) => {
         if (res.statusCode === 200) {
           const formattedHistory = res.data.map(item => ({
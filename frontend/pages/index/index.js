@@ -60,6 +60,9 @@ Page({
       url: `${app.globalData.API_URL}/api/analyze`,
       filePath: filePath,
       name: 'file',
+      header: {
+        'X-Session-Token': app.globalData.sessionToken
+      },
       formData: {
         user_id: userId
       },
@@ -80,6 +83,18 @@ Page({
               icon: 'none'
             });
           }
+        } else if (res.statusCode === 429) {
+          // 请求过于频繁
+          wx.showToast({
+            title: '请求过于频繁，请稍后再试',
+            icon: 'none'
+          });
+        } else if (res.statusCode === 503) {
+          // 识别服务繁忙
+          wx.showToast({
+            title: '服务繁忙，请稍后再试',
+            icon: 'none'
+          });
         } else {
           // 处理非200的HTTP状态
           wx.showToast({
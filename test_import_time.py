@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动耗时测试
+使用 `python -X importtime` 测量导入 main:app 的耗时，并检查重量级依赖没有在导入时被加载
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent / "backend"
+
+# main:app 自身的导入耗时预算（毫秒）：导入 main:app 的总耗时减去只导入框架依赖的基线耗时。
+# 实测约 50-120ms；用差值而不是绝对值，测试结果不受机器快慢和负载影响。可通过环境变量调整
+IMPORT_TIME_BUDGET_MS = float(os.environ.get("IMPORT_TIME_BUDGET_MS", "200"))
+
+# 取多次测量中的最小值，降低机器负载带来的波动
+IMPORT_TIME_RUNS = 5
+
+# main:app 无论如何都要加载的第三方依赖，作为基线
+BASELINE_IMPORTS = (
+    "import fastapi, fastapi.staticfiles, fastapi.middleware.cors, "
+    "sqlalchemy.orm, sqlalchemy.ext.declarative, dotenv, multipart"
+)
+
+# 这些模块只应在首次使用或启动阶段加载
+LAZY_MODULES = ("alibabacloud_ocr_api20210707", "alibabacloud_tea_openapi", "uvicorn")
+
+
+def measure_import(code="from main import app"):
+    """
+    在干净的子进程中执行导入语句，返回 ({模块名: 累计耗时(微秒)}, 顶层导入的总耗时(微秒))。
+    """
+    env = dict(os.environ)
+    # 未配置密钥时导入也必须成功
+    env.pop("ALIYUN_ACCESS_KEY_ID", None)
+    env.pop("ALIYUN_ACCESS_KEY_SECRET", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+    timings = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = int(cumulative)
+        # 名称前只有一个空格的是顶层导入，嵌套导入的耗时已包含在其中
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return timings, total
+
+
+def test_import_time_budget():
+    """main:app 在框架依赖之外的导入耗时不超过预算"""
+    app_runs, baseline_runs = [], []
+    for _ in range(IMPORT_TIME_RUNS):
+        # 交替测量，使两者受到相同的机器负载影响
+        app_runs.append(measure_import()[1])
+        baseline_runs.append(measure_import(BASELINE_IMPORTS)[1])
+    app_ms, baseline_ms = min(app_runs) / 1000, min(baseline_runs) / 1000
+    overhead_ms = app_ms - baseline_ms
+    print(
+        f"导入 main:app 耗时: {app_ms:.1f}ms，框架基线: {baseline_ms:.1f}ms，"
+        f"应用自身: {overhead_ms:.1f}ms (预算 {IMPORT_TIME_BUDGET_MS:.0f}ms)"
+    )
+    assert overhead_ms <= IMPORT_TIME_BUDGET_MS
+
+
+def test_heavy_modules_are_lazy():
+    """阿里云SDK和uvicorn不在导入时加载"""
+    timings, _ = measure_import()
+    loaded = [name for name in timings if name.split(".")[0] in LAZY_MODULES]
+    assert not loaded, f"导入时加载了: {loaded}"
+
+
+if __name__ == "__main__":
+    test_import_time_budget()
+    test_heavy_modules_are_lazy()
+    print("✅ 启动耗时测试通过")
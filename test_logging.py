@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志子系统测试
+验证结构化JSON格式、载荷采样和请求ID中间件
+"""
+
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "backend"))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from config.production import config  # noqa: E402
+from app import logging_config  # noqa: E402
+from app.logging_config import (  # noqa: E402
+    JsonFormatter,
+    LazyQueueHandler,
+    PayloadSamplingFilter,
+    RequestIdFilter,
+    RequestIdMiddleware,
+    claim_worker_slot,
+    request_id_var,
+    worker_log_file,
+)
+
+
+def make_record(msg, *args, exc_info=None, **extra):
+    record = logging.LogRecord("app.test", logging.INFO, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter_fields():
+    """消息惰性格式化，extra 字段展开到顶层，内部字段不输出"""
+    record = make_record("hello %s", "世界", user_id="u1", payload=True)
+    token = request_id_var.set("req-1")
+    try:
+        RequestIdFilter().filter(record)
+    finally:
+        request_id_var.reset(token)
+
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["msg"] == "hello 世界"
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "app.test"
+    assert entry["request_id"] == "req-1"
+    assert entry["user_id"] == "u1"
+    assert "payload" not in entry
+    assert "args" not in entry
+
+
+def test_json_formatter_exc_info():
+    """异常信息以文本形式输出"""
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record("failed", exc_info=sys.exc_info())
+    entry = json.loads(JsonFormatter().format(record))
+    assert "ValueError: boom" in entry["exc_info"]
+
+
+def test_queue_handler_snapshots_exc_info():
+    """入队时在调用线程中渲染异常堆栈并释放 exc_info，消息参数保持惰性"""
+    log_queue = queue.SimpleQueue()
+    handler = LazyQueueHandler(log_queue)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        handler.handle(make_record("failed %s", "x", exc_info=sys.exc_info()))
+
+    record = log_queue.get_nowait()
+    assert record.exc_info is None
+    assert "ValueError: boom" in record.exc_text
+    assert record.args == ("x",)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["msg"] == "failed x"
+    assert "ValueError: boom" in entry["exc_info"]
+
+
+def test_payload_sampling_filter():
+    """采样率只作用于 payload 日志"""
+    normal = make_record("normal")
+    payload = make_record("body", payload=True)
+
+    assert PayloadSamplingFilter(0).filter(normal)
+    assert not PayloadSamplingFilter(0).filter(payload)
+    assert PayloadSamplingFilter(1).filter(payload)
+
+    kept = sum(PayloadSamplingFilter(0.5).filter(payload) for _ in range(2000))
+    assert 800 < kept < 1200
+
+
+def test_request_id_middleware():
+    """沿用客户端传入的请求ID，否则生成新的；请求内可以读取，请求结束后复位"""
+    app = FastAPI()
+    seen = []
+
+    @app.get("/x")
+    def endpoint():
+        seen.append(request_id_var.get())
+        return {}
+
+    app.add_middleware(RequestIdMiddleware)
+    client = TestClient(app)
+
+    response = client.get("/x", headers={"X-Request-ID": "abc"})
+    assert response.headers["x-request-id"] == "abc"
+    assert seen[-1] == "abc"
+
+    response = client.get("/x")
+    generated = response.headers["x-request-id"]
+    assert len(generated) == 32
+    assert seen[-1] == generated
+    assert request_id_var.get() == "-"
+
+
+def test_worker_slots_are_reused():
+    """同时运行的 worker 占用不同编号，退出后编号被复用，日志文件数量不随重启增长"""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "app")
+        first, first_lock = claim_worker_slot(root)
+        second, second_lock = claim_worker_slot(root)
+        assert (first, second) == (0, 1)
+
+        first_lock.close()
+        restarted, restarted_lock = claim_worker_slot(root)
+        assert restarted == 0
+        restarted_lock.close()
+        second_lock.close()
+
+
+def test_worker_log_file_has_slot():
+    """日志文件名带 worker 编号，同一进程内保持不变"""
+    saved = config.LOG_FILE, logging_config._worker_slot, logging_config._worker_slot_lock
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            config.LOG_FILE = os.path.join(tmp, "app.log")
+            logging_config._worker_slot = logging_config._worker_slot_lock = None
+            path = worker_log_file()
+            assert re.fullmatch(re.escape(os.path.join(tmp, "app.")) + r"\d+\.log", path)
+            assert worker_log_file() == path
+        finally:
+            if logging_config._worker_slot_lock is not None:
+                logging_config._worker_slot_lock.close()
+            config.LOG_FILE, logging_config._worker_slot, logging_config._worker_slot_lock = saved
+
+
+if __name__ == "__main__":
+    test_json_formatter_fields()
+    test_json_formatter_exc_info()
+    test_queue_handler_snapshots_exc_info()
+    test_payload_sampling_filter()
+    test_request_id_middleware()
+    test_worker_slots_are_reused()
+    test_worker_log_file_has_slot()
+    print("✅ 日志测试通过")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能剖析测试
+验证按需剖析、慢请求捕获、环形缓冲区和管理接口
+"""
+
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "backend"))
+
+from fastapi import APIRouter, FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from config.production import config  # noqa: E402
+from app import profiling  # noqa: E402
+from app.api import admin  # noqa: E402
+
+TOKEN = "s3cret"
+ADMIN_HEADERS = {"X-Admin-Token": TOKEN}
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+@contextmanager
+def profiling_app(**overrides):
+    """启动剖析子系统并返回测试客户端，结束时恢复配置"""
+    with tempfile.TemporaryDirectory() as tmp:
+        settings = {
+            "ADMIN_TOKEN": TOKEN,
+            "PROFILE_DIR": tmp,
+            "PROFILE_SAMPLE_RATE": 0,
+            "PROFILE_SLOW_THRESHOLD_MS": 100,
+            "PROFILE_INTERVAL_MS": 5,
+            "PROFILE_MAX_CAPTURES": 50,
+            "PROFILE_MAX_SAMPLED_CAPTURES": 20,
+        }
+        settings.update(overrides)
+        saved = {key: getattr(config, key) for key in settings}
+        for key, value in settings.items():
+            setattr(config, key, value)
+
+        router = APIRouter(route_class=profiling.ProfiledRoute)
+
+        @router.get("/fast")
+        def fast():
+            return {}
+
+        @router.get("/slow")
+        def slow():
+            busy(0.2)
+            return {}
+
+        @router.get("/async-slow")
+        async def async_slow():
+            busy(0.2)
+            return {}
+
+        @router.get("/boom")
+        def boom():
+            busy(0.2)
+            raise RuntimeError("boom")
+
+        app = FastAPI()
+        app.include_router(router, prefix="/api")
+        app.include_router(admin.router, prefix="/api/admin")
+        app.add_middleware(profiling.ProfilingMiddleware)
+
+        profiling.setup_profiling()
+        try:
+            yield TestClient(app, raise_server_exceptions=False)
+        finally:
+            profiling.shutdown_profiling()
+            for key, value in saved.items():
+                setattr(config, key, value)
+
+
+def list_captures(client):
+    response = client.get("/api/admin/profiles", headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_explicit_header_requires_token():
+    """X-Profile 只有配合正确的管理令牌才生效"""
+    with profiling_app() as client:
+        response = client.get("/api/fast", headers={"X-Profile": "1", "X-Admin-Token": "wrong"})
+        assert "x-profile-id" not in response.headers
+        assert list_captures(client) == []
+
+        response = client.get("/api/fast", headers={"X-Profile": "1", **ADMIN_HEADERS})
+        capture_id = response.headers["x-profile-id"]
+        captures = list_captures(client)
+        assert [c["id"] for c in captures] == [capture_id]
+        assert captures[0]["reason"] == "requested"
+
+
+def test_slow_request_capture_has_samples():
+    """慢请求自动捕获，没有 stage 的接口也有调用栈样本"""
+    with profiling_app() as client:
+        client.get("/api/fast")
+        client.get("/api/slow")
+        captures = list_captures(client)
+        assert len(captures) == 1
+        assert captures[0]["path"] == "/api/slow"
+        assert captures[0]["reason"] == "slow"
+        assert captures[0]["samples"] > 0
+
+        capture = client.get(f"/api/admin/profiles/{captures[0]['id']}", headers=ADMIN_HEADERS).json()
+        assert any("slow (test_profiling.py" in line for line in capture["stacks"])
+
+
+def test_event_loop_samples_exclude_idle_and_threadpool_time():
+    """同步接口在线程池中执行时不采事件循环线程；在事件循环上执行的异步接口照常采样"""
+    with profiling_app() as client:
+        client.get("/api/slow")
+        client.get("/api/async-slow")
+        captures = {c["path"]: c["id"] for c in list_captures(client)}
+
+        sync_stacks = client.get(f"/api/admin/profiles/{captures['/api/slow']}", headers=ADMIN_HEADERS).json()["stacks"]
+        loop_samples = sum(int(line.rsplit(" ", 1)[1]) for line in sync_stacks if line.startswith("[event loop]"))
+        total_samples = sum(int(line.rsplit(" ", 1)[1]) for line in sync_stacks)
+        assert loop_samples < total_samples / 4
+        assert not any("select (selectors.py" in line for line in sync_stacks)
+
+        async_stacks = client.get(f"/api/admin/profiles/{captures['/api/async-slow']}", headers=ADMIN_HEADERS).json()["stacks"]
+        assert any(line.startswith("[event loop]") and "async_slow (test_profiling.py" in line for line in async_stacks)
+
+
+def test_failed_slow_request_is_captured():
+    """出错的慢请求同样被捕获"""
+    with profiling_app() as client:
+        assert client.get("/api/boom").status_code == 500
+        captures = list_captures(client)
+        assert len(captures) == 1
+        assert captures[0]["status_code"] == 500
+        assert "boom" in captures[0]["error"]
+
+
+def test_ring_buffer_eviction():
+    """超过 PROFILE_MAX_CAPTURES 时删除最旧的捕获"""
+    with profiling_app(PROFILE_MAX_CAPTURES=2) as client:
+        ids = [
+            client.get("/api/fast", headers={"X-Profile": "1", **ADMIN_HEADERS}).headers["x-profile-id"]
+            for _ in range(3)
+        ]
+        # 捕获ID按创建顺序排序，列表按时间倒序返回，第一个请求的捕获被删除
+        assert sorted(ids) == ids
+        assert [c["id"] for c in list_captures(client)] == [ids[2], ids[1]]
+
+
+def test_sampled_captures_do_not_evict_slow_captures():
+    """随机抽样的捕获单独计数，不会挤掉慢请求的捕获"""
+    with profiling_app(PROFILE_SAMPLE_RATE=1, PROFILE_MAX_CAPTURES=2, PROFILE_MAX_SAMPLED_CAPTURES=3) as client:
+        client.get("/api/slow")
+        for _ in range(10):
+            response = client.get("/api/fast")
+            assert "x-profile-id" not in response.headers
+        reasons = [c["reason"] for c in list_captures(client)]
+        assert reasons.count("slow") == 1
+        assert reasons.count("sampled") == 3
+
+        sampled_id = next(c["id"] for c in list_captures(client) if c["reason"] == "sampled")
+        assert client.get(f"/api/admin/profiles/{sampled_id}", headers=ADMIN_HEADERS).status_code == 200
+
+
+def test_zero_max_captures_disables_capture():
+    """PROFILE_MAX_CAPTURES=0 时不写入任何捕获"""
+    with profiling_app(PROFILE_MAX_CAPTURES=0) as client:
+        client.get("/api/slow")
+        assert client.get("/api/admin/profiles", headers=ADMIN_HEADERS).status_code == 503
+
+
+def test_non_positive_interval_is_clamped():
+    """PROFILE_INTERVAL_MS<=0 时按 1ms 采样，而不是让采样线程空转"""
+    with profiling_app(PROFILE_INTERVAL_MS=0) as client:
+        assert profiling._sampler.interval == 0.001
+        client.get("/api/slow")
+        captures = list_captures(client)
+        assert captures[0]["samples"] > 0
+        capture = client.get(f"/api/admin/profiles/{captures[0]['id']}", headers=ADMIN_HEADERS).json()
+        assert capture["sample_interval_ms"] == 1
+
+
+def test_admin_forbidden_without_configured_token():
+    """未配置 ADMIN_TOKEN 时管理接口一律返回 403"""
+    with profiling_app(ADMIN_TOKEN="") as client:
+        assert client.get("/api/admin/profiles").status_code == 403
+        assert client.get("/api/admin/profiles", headers={"X-Admin-Token": ""}).status_code == 403
+
+
+def test_folded_format_download():
+    """format=folded 返回火焰图工具可读的折叠调用栈"""
+    with profiling_app() as client:
+        client.get("/api/slow")
+        capture_id = list_captures(client)[0]["id"]
+        response = client.get(f"/api/admin/profiles/{capture_id}?format=folded", headers=ADMIN_HEADERS)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        lines = response.text.strip().splitlines()
+        assert lines
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert ";" in stack
+            assert int(count) > 0
+
+
+def test_bad_capture_id_rejected():
+    """非法的捕获ID（包括路径穿越）返回 404"""
+    with profiling_app() as client:
+        for capture_id in ["..%2F..%2Fetc%2Fpasswd", "not-an-id", "20260101T000000Z-zzzzzzzz"]:
+            response = client.get(f"/api/admin/profiles/{capture_id}", headers=ADMIN_HEADERS)
+            assert response.status_code == 404
+
+
+if __name__ == "__main__":
+    test_explicit_header_requires_token()
+    test_slow_request_capture_has_samples()
+    test_event_loop_samples_exclude_idle_and_threadpool_time()
+    test_failed_slow_request_is_captured()
+    test_ring_buffer_eviction()
+    test_sampled_captures_do_not_evict_slow_captures()
+    test_zero_max_captures_disables_capture()
+    test_non_positive_interval_is_clamped()
+    test_admin_forbidden_without_configured_token()
+    test_folded_format_download()
+    test_bad_capture_id_rejected()
+    print("✅ 性能剖析测试通过")
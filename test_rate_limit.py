@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+限流测试
+使用进程内令牌桶存储，以及 fakeredis（带Lua支持）作为 Redis 的本地替身，验证限流中间件和OCR并发上限
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "backend"))
+
+from fastapi import FastAPI, HTTPException  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from config.production import config  # noqa: E402
+from app.rate_limit import (  # noqa: E402
+    ConcurrencyLimiter,
+    MemoryBucketStore,
+    RateLimitMiddleware,
+    RedisBucketStore,
+    default_buckets,
+)
+from app.security import create_session_token, verify_session_token  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def take(store, keys, buckets):
+    return asyncio.run(store.take(keys, buckets))
+
+
+def test_token_bucket_refill():
+    """桶用尽后拒绝，按速率补充后恢复"""
+    clock = FakeClock()
+    store = MemoryBucketStore(clock=clock)
+    buckets = [("minute", 3, 3 / 60)]
+
+    assert [take(store, ["u1"], buckets)[0] for _ in range(3)] == [True, True, True]
+    allowed, retry_after = take(store, ["u1"], buckets)
+    assert not allowed
+    assert retry_after == 20
+
+    # 其他客户端不受影响
+    assert take(store, ["u2"], buckets)[0]
+
+    clock.now += 20
+    assert take(store, ["u1"], buckets)[0]
+    assert not take(store, ["u1"], buckets)[0]
+
+
+def test_all_buckets_must_have_tokens():
+    """每小时的桶用尽时，即使每分钟的桶还有令牌也要拒绝"""
+    clock = FakeClock()
+    store = MemoryBucketStore(clock=clock)
+    buckets = [("minute", 10, 10 / 60), ("hour", 2, 2 / 3600)]
+
+    assert take(store, ["u1"], buckets)[0]
+    assert take(store, ["u1"], buckets)[0]
+    allowed, retry_after = take(store, ["u1"], buckets)
+    assert not allowed
+    assert retry_after == 1800
+
+
+def test_zero_limit_disables_bucket():
+    """限额为0的时间窗口不限流，而不是除零出错"""
+    saved = config.RATE_LIMIT_PER_MINUTE, config.RATE_LIMIT_PER_HOUR
+    try:
+        config.RATE_LIMIT_PER_MINUTE, config.RATE_LIMIT_PER_HOUR = 0, 100
+        assert [name for name, _, _ in default_buckets()] == ["hour"]
+        config.RATE_LIMIT_PER_MINUTE, config.RATE_LIMIT_PER_HOUR = 0, 0
+        assert default_buckets() == []
+        client = make_client(default_buckets())
+        for _ in range(5):
+            assert client.get("/api/history/u1").status_code == 200
+    finally:
+        config.RATE_LIMIT_PER_MINUTE, config.RATE_LIMIT_PER_HOUR = saved
+
+
+def test_session_token():
+    """会话令牌可以验证，篡改或过期后无效"""
+    token = create_session_token("user_abc.def")
+    assert verify_session_token(token) == "user_abc.def"
+    assert verify_session_token(token.replace("user_abc", "user_xyz")) is None
+    assert verify_session_token("user_abc") is None
+    assert verify_session_token(None) is None
+
+    saved = config.SESSION_MAX_AGE
+    try:
+        config.SESSION_MAX_AGE = -1
+        assert verify_session_token(create_session_token("user_abc")) is None
+    finally:
+        config.SESSION_MAX_AGE = saved
+
+
+def make_app(buckets):
+    app = FastAPI()
+
+    @app.get("/")
+    def health_check():
+        return {"status": "ok"}
+
+    @app.get("/api/history/{user_id}")
+    def read_history(user_id: str):
+        return []
+
+    @app.post("/api/login")
+    def login():
+        return {}
+
+    app.add_middleware(RateLimitMiddleware, store=MemoryBucketStore(), buckets=buckets)
+    return app
+
+
+def make_client(buckets, ip="testclient"):
+    return TestClient(make_app(buckets), client=(ip, 50000))
+
+
+def test_middleware_returns_429_with_retry_after():
+    """超限请求返回 429 和 Retry-After，健康检查不限流"""
+    client = make_client([("minute", 2, 2 / 60)])
+
+    assert client.get("/api/history/u1").status_code == 200
+    assert client.get("/api/history/u1").status_code == 200
+    response = client.get("/api/history/u1")
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "30"
+
+    for _ in range(5):
+        assert client.get("/").status_code == 200
+
+
+def test_client_claimed_user_id_cannot_bypass_ip_limit():
+    """更换 X-User-Id、路径中的 user_id 或伪造会话令牌都计入同一个IP桶"""
+    client = make_client([("minute", 3, 3 / 60)])
+
+    statuses = [
+        client.post("/api/login", headers={"X-User-Id": f"user_{i}", "X-Session-Token": f"user_{i}.9999999999.bad"}).status_code
+        for i in range(5)
+    ]
+    assert statuses == [200, 200, 200, 429, 429]
+    assert client.get("/api/history/someone_else").status_code == 429
+
+
+def test_session_user_limited_across_ips():
+    """持有有效会话令牌的用户换IP也会被限流，其他IP的其他用户不受影响"""
+    app = make_app([("minute", 3, 3 / 60)])
+    token = create_session_token("user_1")
+
+    statuses = [
+        TestClient(app, client=(f"10.0.0.{i}", 50000))
+        .get("/api/history/user_1", headers={"X-Session-Token": token})
+        .status_code
+        for i in range(4)
+    ]
+    assert statuses == [200, 200, 200, 429]
+    assert TestClient(app, client=("10.0.0.9", 50000)).get("/api/history/user_2").status_code == 200
+
+
+def test_spoofed_real_ip_from_untrusted_peer_ignored():
+    """绕过 nginx 直连时，伪造的 X-Real-IP 仍计入直连对端的IP桶"""
+    saved = config.RATE_LIMIT_TRUSTED_PROXIES
+    try:
+        config.RATE_LIMIT_TRUSTED_PROXIES = ["172.20.0.0/16"]
+        client = make_client([("minute", 3, 3 / 60)], ip="203.0.113.7")
+        statuses = [
+            client.get("/api/history/u1", headers={"X-Real-IP": f"10.0.0.{i}"}).status_code
+            for i in range(5)
+        ]
+        assert statuses == [200, 200, 200, 429, 429]
+    finally:
+        config.RATE_LIMIT_TRUSTED_PROXIES = saved
+
+
+def test_real_ip_from_trusted_proxy_used():
+    """受信任代理转发的请求按 X-Real-IP 区分客户端"""
+    saved = config.RATE_LIMIT_TRUSTED_PROXIES
+    try:
+        config.RATE_LIMIT_TRUSTED_PROXIES = ["172.20.0.0/16"]
+        client = make_client([("minute", 3, 3 / 60)], ip="172.20.0.5")
+        statuses = [
+            client.get("/api/history/u1", headers={"X-Real-IP": f"10.0.0.{i % 2}"}).status_code
+            for i in range(8)
+        ]
+        assert statuses == [200] * 6 + [429, 429]
+    finally:
+        config.RATE_LIMIT_TRUSTED_PROXIES = saved
+
+
+def redis_store():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return RedisBucketStore("redis://unused", client=fakeredis.FakeAsyncRedis())
+
+
+def test_redis_store_rejects_and_refills():
+    """Redis 存储：通过Lua脚本扣减，超限后拒绝，按速率补充后恢复"""
+    store = redis_store()
+    buckets = [("second", 2, 20)]
+
+    async def scenario():
+        results = [await store.take(["ip:1"], buckets) for _ in range(3)]
+        # 其他客户端不受影响
+        other = await store.take(["ip:2"], buckets)
+        await asyncio.sleep(0.1)
+        refilled = await store.take(["ip:1"], buckets)
+        return results, other, refilled
+
+    results, other, refilled = asyncio.run(scenario())
+    assert [allowed for allowed, _ in results] == [True, True, False]
+    assert 0 < results[2][1] <= 0.05
+    assert other[0]
+    assert refilled[0]
+
+
+def test_redis_store_checks_all_keys_atomically():
+    """任一键超限时整体拒绝，且不扣减其他键的令牌"""
+    store = redis_store()
+    buckets = [("minute", 1, 1 / 60)]
+
+    async def scenario():
+        first = await store.take(["ip:1", "user:a"], buckets)
+        # user:a 已用尽，换IP也被拒绝；ip:2 的令牌不会被扣
+        second = await store.take(["ip:2", "user:a"], buckets)
+        third = await store.take(["ip:2"], buckets)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert first[0]
+    assert not second[0]
+    assert 59 < second[1] <= 60
+    assert third[0]
+
+
+class BrokenScript:
+    async def __call__(self, keys, args):
+        raise ConnectionError("redis down")
+
+
+def test_redis_unavailable_falls_back_to_memory_and_warns_once(caplog):
+    """Redis 不可用时退回到进程内限流而不是全部放行，告警只输出一次"""
+    store = RedisBucketStore("redis://unused")
+    store._script = BrokenScript()
+
+    with caplog.at_level(logging.WARNING, logger="app.rate_limit"):
+        results = [take(store, ["ip:1"], [("minute", 1, 1 / 60)])[0] for _ in range(5)]
+    assert results == [True, False, False, False, False]
+    assert len([r for r in caplog.records if "unavailable" in r.getMessage()]) == 1
+
+
+def test_concurrency_limiter_sheds_load():
+    """并发名额和等待队列都满时立即返回 503"""
+    limiter = ConcurrencyLimiter(max_concurrency=1, queue_size=1, timeout=5)
+    limiter.acquire()
+
+    waiter_done = threading.Event()
+
+    def waiter():
+        limiter.acquire()
+        limiter.release()
+        waiter_done.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    while limiter._waiting == 0:
+        pass
+
+    try:
+        limiter.acquire()
+    except HTTPException as e:
+        assert e.status_code == 503
+        assert e.headers["Retry-After"] == "5"
+    else:
+        raise AssertionError("expected HTTPException")
+
+    limiter.release()
+    thread.join()
+    assert waiter_done.is_set()
+
+
+def test_concurrency_limiter_times_out():
+    """排队超时同样返回 503"""
+    limiter = ConcurrencyLimiter(max_concurrency=1, queue_size=4, timeout=0.05)
+    limiter.acquire()
+    try:
+        limiter.acquire()
+    except HTTPException as e:
+        assert e.status_code == 503
+    else:
+        raise AssertionError("expected HTTPException")
+    finally:
+        limiter.release()
+
+
+def test_ocr_limits_must_leave_threadpool_headroom():
+    """OCR并发和排队上限之和超过线程池一半时配置校验失败"""
+    saved = config.OCR_MAX_CONCURRENCY, config.OCR_QUEUE_SIZE
+    try:
+        config.OCR_MAX_CONCURRENCY, config.OCR_QUEUE_SIZE = 4, config.THREADPOOL_SIZE // 2 - 4
+        config.validate_ocr_limits()
+        config.OCR_QUEUE_SIZE += 1
+        with pytest.raises(ValueError):
+            config.validate_ocr_limits()
+    finally:
+        config.OCR_MAX_CONCURRENCY, config.OCR_QUEUE_SIZE = saved
+
+
+if __name__ == "__main__":
+    test_token_bucket_refill()
+    test_all_buckets_must_have_tokens()
+    test_zero_limit_disables_bucket()
+    test_session_token()
+    test_middleware_returns_429_with_retry_after()
+    test_client_claimed_user_id_cannot_bypass_ip_limit()
+    test_session_user_limited_across_ips()
+    test_spoofed_real_ip_from_untrusted_peer_ignored()
+    test_real_ip_from_trusted_proxy_used()
+    test_redis_store_rejects_and_refills()
+    test_redis_store_checks_all_keys_atomically()
+    test_concurrency_limiter_sheds_load()
+    test_concurrency_limiter_times_out()
+    test_ocr_limits_must_leave_threadpool_headroom()
+    print("✅ 限流测试通过")